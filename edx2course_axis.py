@@ -39,14 +39,20 @@ import os
 import sys
 import re
 import csv
+import io
 import logging
-import codecs
+import operator
+import itertools
 import json
 import glob
+import multiprocessing
 import datetime
 import xbundle
 import tempfile
-from collections import namedtuple, defaultdict
+import tarfile
+import traceback
+import shutil
+from collections import namedtuple
 from lxml import etree
 from path import path
 from fix_unicode import fix_bad_unicode
@@ -63,9 +69,85 @@ logging.basicConfig()
 log.setLevel(logging.DEBUG)
 
 # storage class for each axis element
-Axel = namedtuple(
-    'Axel',
-    'course_id index url_name category gformat start due name path module_id data chapter_mid')
+class Axel(namedtuple(
+        'Axel',
+        'course_id index url_name category gformat start due name path module_id data chapter_mid')):
+    """
+    Course axis element.  A namedtuple, with no per-instance __dict__.
+    """
+    __slots__ = ()
+
+    def to_dict(self):
+        """
+        Return dict of the AXIS_HEADER fields, ie all but course_id.
+        """
+        (_, index, url_name, category, gformat, start, due, name, path_str,
+         module_id, data, chapter_mid) = self
+        return {
+            'index': index, 'url_name': url_name, 'category': category,
+            'gformat': gformat, 'start': start, 'due': due, 'name': name,
+            'path': path_str, 'module_id': module_id, 'data': data,
+            'chapter_mid': chapter_mid,
+        }
+
+# columns of the course axis output files
+AXIS_HEADER = (
+    "index", "url_name", "category", "gformat", "start", 'due',
+    "name", "path", "module_id", "data", "chapter_mid",
+)
+
+# elements whose children are not walked
+LEAF_TAGS = frozenset([
+    'html', 'problem', 'discussion', 'customtag', 'poll_question',
+    'combinedopenended', 'metadata',
+])
+
+# second level of the hierarchy: `course > chapter > (problemset |
+# sequential | videosequence)`
+SEQ_TAGS = frozenset([
+    'problemset', 'sequential', 'videosequence', 'proctor', 'randomize'
+])
+
+# children skipped entirely by walk, along with their subtrees
+SKIP_TAGS = frozenset(['discussion', 'source'])
+
+# elements expected to have no url_name, which walk does not warn about
+NO_URL_NAME_TAGS = frozenset(['transcript', 'wiki', 'metadata'])
+
+# youtube id in the src of an embedded youtube iframe
+YT_EMBED_HOST = 'https://www.youtube.com/embed/'
+YT_EMBED_RE = re.compile(r'embed/([^"/?]+)')
+
+# shared parser for course XML: no whitespace-only text nodes, no id
+# hashtable, no entity expansion, and no limit on very large documents
+XML_PARSER = etree.XMLParser(
+    huge_tree=True,
+    remove_blank_text=True,
+    collect_ids=False,
+    resolve_entities=False,
+)
+
+# whitespace in XML (a bare str.strip() would also strip eg U+00A0)
+XML_BLANKS = ' \t\r\n'
+
+# marker for cache misses, where None is a valid cached value
+_SENTINEL = object()
+
+
+def _is_set(val):
+    """
+    True if an xml attribute value sets a setting, ie is not missing,
+    "null" or empty.
+    """
+    return val is not None and not val == 'null' and not val == ""
+
+
+def load_json_file(filename):
+    """
+    Load JSON from file, as raw bytes (decoding is left to the JSON parser).
+    """
+    with open(filename, 'rb') as fp:
+        return json.loads(fp.read())
 
 
 class Policy(object):
@@ -76,7 +158,7 @@ class Policy(object):
     """
     policy = None
     grading_policy = None
-    InheritedSettings = ['format', 'hide_from_toc', 'start', 'due']
+    InheritedSettings = frozenset(['format', 'hide_from_toc', 'start', 'due'])
 
     def __init__(self, pfn):
         """
@@ -84,108 +166,323 @@ class Policy(object):
         """
         self.pfn = path(pfn)
         print "loading policy file %s" % pfn
-        self.policy = json.loads(open(pfn).read())
+        self.policy = load_json_file(pfn)
+        # semester is the name of the (single) "course/..." policy key
+        self._semesters = [
+            x.split("/", 1)[1] for x in self.policy if x.startswith("course/")
+        ]
 
         gfn = self.pfn.dirname() / 'grading_policy.json'
         if os.path.exists(gfn):
             self.gfn = gfn
-            self.grading_policy = json.loads(open(gfn).read())
+            self.grading_policy = load_json_file(gfn)
+
+        self._policy_get = self.policy.get
+        self._cache = {}
+        self._alive = []
+        self._overrides = {}
+        self._policy_json = None
+        self._grading_policy_json = None
+
+    @property
+    def policy_json(self):
+        """
+        Policy serialized as a JSON string, computed once.
+        """
+        if self._policy_json is None:
+            self._policy_json = json.dumps(self.policy)
+        return self._policy_json
+
+    @property
+    def grading_policy_json(self):
+        """
+        Grading policy serialized as a JSON string, computed once.
+        """
+        if self._grading_policy_json is None:
+            self._grading_policy_json = json.dumps(self.grading_policy)
+        return self._grading_policy_json
 
     @property
     def semester(self):
         """
-        Find "semester" string inside JSON object.
+        "semester" string found inside JSON object (see __init__).
         """
-        keys = [x for x in self.policy.keys() if x.startswith("course/")]
-        assert len(keys) == 1
-        return keys[0].split("/", 1)[1]
+        assert len(self._semesters) == 1
+        return self._semesters[0]
 
     def get_metadata(self, xml, setting, default=None, parent=False):
         """
         Retrieve policy for xml element, given the policy JSON and, for a specific setting.
         Handles inheritance of certain settings (like format and hide_from_toc)
 
+        Results are memoized per (element, setting), so that inherited
+        settings are only resolved once along each chain of ancestors.
+
         xml = etree
         setting = string
         """
+        key = (id(xml), setting, default, parent)
+        val = self._cache.get(key, _SENTINEL)
+        if val is _SENTINEL:
+            val = self._lookup_metadata(xml, setting, default, parent)
+            self._cache[key] = val
+            # keep element alive, so its id() is not reused while cached
+            self._alive.append(xml)
+        return val
+
+    def _lookup_metadata(self, xml, setting, default, parent):
+        """
+        Uncached version of get_metadata.
+        """
         if parent:
-            val = xml.get(setting, None)
-            if val is not None and not val == 'null' and (
-                    (setting in self.InheritedSettings) and not val == ""):
+            val = self._get_attribute(xml, setting)
+            if setting in self.InheritedSettings and _is_set(val):
                 return val
 
-        url_name = xml.get(
-            'url_name', xml.get('url_name_orig', '<no_url_name>'))
-        pkey = '%s/%s' % (xml.tag, url_name)
-
-        if pkey in self.policy and setting in self.policy[pkey]:
-            return self.policy[pkey][setting]
+        pdata = self._policy_entry(xml)
+        if pdata is not None and setting in pdata:
+            return pdata[setting]
 
         if not setting in self.InheritedSettings:
             return default
 
-        parent = xml.getparent()  # inherited metadata: try parent
-        if parent is not None:
-            return self.get_metadata(parent, setting, default, parent=True)
+        return self._get_inherited(xml, setting, default)
+
+    def _get_inherited(self, xml, setting, default):
+        """
+        Resolve inherited setting for xml element from its ancestors, nearest
+        first.
+        """
+        return self._resolve_inherited(
+            xml.iterancestors(), (setting,), default)[0]
+
+    def _resolve_inherited(self, elems, settings, default):
+        """
+        Resolve inherited settings from elems, nearest first, returning a
+        tuple of values in the order of settings (None if never set).
+
+        Each setting is resolved as get_metadata(elem, setting, default,
+        parent=True) would for the elements passed on the way, and the
+        result is memoized for all of them, since they inherit the same
+        value.
+        """
+        cache = self._cache
+        found = {}
+        passed = dict((setting, []) for setting in settings)
+        pending = settings
+        for elem in elems:
+            pdata = None
+            for setting in pending:
+                val = cache.get((id(elem), setting, default, True), _SENTINEL)
+                if val is _SENTINEL:
+                    passed[setting].append(elem)
+                    val = self._get_attribute(elem, setting)
+                    if not _is_set(val):
+                        if pdata is None:
+                            pdata = self._policy_entry(elem) or {}
+                        val = pdata.get(setting, _SENTINEL)
+                if val is not _SENTINEL:
+                    found[setting] = val
+            pending = [setting for setting in pending if setting not in found]
+            if not pending:
+                break
+
+        for setting in settings:
+            val = found.get(setting)
+            for elem in passed[setting]:
+                cache[(id(elem), setting, default, True)] = val
+            self._alive.extend(passed[setting])
+        return tuple(found.get(setting) for setting in settings)
+
+    def get_all_metadata(self, xml, defaults):
+        """
+        Retrieve several settings for xml element at once, ie
+
+            {setting: get_metadata(xml, setting, default)}
+
+        for each (setting, default) in the defaults dict, but looking up
+        the element's policy entry only once.
+        """
+        pdata = self._policy_entry(xml) or {}
+        ret = {}
+        for setting, default in defaults.iteritems():
+            if setting in pdata:
+                ret[setting] = pdata[setting]
+            elif setting in self.InheritedSettings:
+                ret[setting] = self._get_inherited(xml, setting, default)
+            else:
+                ret[setting] = default
+        return ret
+
+    def get_start_and_due(self, xml):
+        """
+        Return (start, due) for xml element, ie the same as
+
+            get_metadata(xml, 'start', '', parent=True)
+            get_metadata(xml, 'due', '', parent=True)
+
+        but resolving both settings in one walk up the ancestors.
+        """
+        return self._resolve_inherited(
+            itertools.chain((xml,), xml.iterancestors()), ('start', 'due'), '')
+
+    def override_attribute(self, xml, setting, val):
+        """
+        Look up setting for xml element (and its descendants, which inherit
+        it) as if the element's attribute were val, leaving the element
+        itself unchanged.  Dropped, like the cache, by clear_cache.
+        """
+        self._overrides.setdefault(id(xml), {})[setting] = val
+        self._alive.append(xml)
+
+    def _get_attribute(self, xml, setting):
+        """
+        Value of the setting's attribute on xml element, or None, taking
+        override_attribute into account.
+        """
+        overrides = self._overrides.get(id(xml))
+        if overrides is not None and setting in overrides:
+            return overrides[setting]
+        return xml.get(setting, None)
+
+    def _policy_entry(self, xml):
+        """
+        Return policy dict for xml element, or None if there is none.
+        """
+        url_name = xml.get(
+            'url_name', xml.get('url_name_orig', '<no_url_name>'))
+        return self._policy_get('%s/%s' % (xml.tag, url_name))
+
+    def clear_cache(self):
+        """
+        Drop memoized get_metadata results and attribute overrides, eg once
+        a course has been walked.
+        """
+        self._cache = {}
+        self._alive = []
+        self._overrides = {}
 
 
 def get_from_parent(xml, attr, default):
     """
-    get attribute from parent, recursing until end or found
+    get attribute from nearest ancestor which has it, or default if none does
     """
-    parent = xml.getparent()
-    if parent is not None:
-        val = parent.get(attr, None)
+    for anc in xml.iterancestors():
+        val = anc.get(attr, None)
         if val is not None:
             return val
-        return get_from_parent(parent, attr, default)
     return default
 
 
+# date formats seen in edX course xml and policies, by the kind of date
+# string: ISO (picked further by suffix, see _date_formats) or month name
+ISO_DATE_RE = re.compile(r'\d{4}-\d{1,2}-\d{1,2}T')
+MONTH_DATE_RE = re.compile(r'[A-Za-z]+\s')
+ISO_Z_DATE_FORMATS = (
+    '%Y-%m-%dT%H:%M:%SZ',    	# 2013-11-13T21:00:00Z
+)
+ISO_UTC_DATE_FORMATS = (
+    '%Y-%m-%dT%H:%M:%S+00:00',  # 2014-12-09T15:00:00+00:00
+)
+ISO_MICROSECOND_DATE_FORMATS = (
+    '%Y-%m-%dT%H:%M:%S.%f',    	# 2012-12-04T13:48:28.427430
+)
+ISO_DATE_FORMATS = (
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M',		    # 2013-02-12T19:00
+)
+MONTH_DATE_FORMATS = (
+    '%B %d, %Y',			    # February 25, 2013
+    '%B %d, %H:%M, %Y', 		# December 12, 22:00, 2012
+    '%B %d, %Y, %H:%M', 		# March 25, 2013, 22:00
+    '%B %d %Y, %H:%M',		    # January 2 2013, 22:00
+    '%B %d %Y', 			    # March 13 2014
+    '%B %d %H:%M, %Y',		    # December 24 05:00, 2012
+)
+
+
+def _date_formats(datestr):
+    """
+    Return the date formats which could possibly match datestr, in order,
+    so that most date strings cost a single strptime call.
+    """
+    if ISO_DATE_RE.match(datestr):
+        if datestr.endswith('Z'):
+            return ISO_Z_DATE_FORMATS
+        if datestr.endswith('+00:00'):
+            return ISO_UTC_DATE_FORMATS
+        if '.' in datestr:
+            return ISO_MICROSECOND_DATE_FORMATS
+        return ISO_DATE_FORMATS
+    if MONTH_DATE_RE.match(datestr):
+        return MONTH_DATE_FORMATS
+    return ()
+
+# cache of date_parse results (None if unparsable), keyed by date string
+_DATE_CACHE = {}
+
+
 def date_parse(datestr, retbad=False):
     """
     Parse a string into a datetime, handling a variety
     of formatting options.
+
+    Results are cached, since the same start and due dates
+    are typically shared by many elements of a course.
     """
     if not datestr:
         return None
 
+    dt = _DATE_CACHE.get(datestr, _SENTINEL)
+    if dt is _SENTINEL:
+        dt = _DATE_CACHE[datestr] = _date_parse(datestr)
+    if dt is None and retbad:
+        return "Bad"
+    return dt
+
+
+def _date_parse(datestr):
+    """
+    Uncached version of date_parse; returns None if unparsable.
+    """
     if datestr.startswith('"') and datestr.endswith('"'):
         datestr = datestr[1:-1]
 
-    formats = [
-        '%Y-%m-%dT%H:%M:%SZ',    	# 2013-11-13T21:00:00Z
-        '%Y-%m-%dT%H:%M:%S.%f',    	# 2012-12-04T13:48:28.427430
-        '%Y-%m-%dT%H:%M:%S',
-        '%Y-%m-%dT%H:%M:%S+00:00',  # 2014-12-09T15:00:00+00:00
-        '%Y-%m-%dT%H:%M',		    # 2013-02-12T19:00
-        '%B %d, %Y',			    # February 25, 2013
-        '%B %d, %H:%M, %Y', 		# December 12, 22:00, 2012
-        '%B %d, %Y, %H:%M', 		# March 25, 2013, 22:00
-        '%B %d %Y, %H:%M',		    # January 2 2013, 22:00
-        '%B %d %Y', 			    # March 13 2014
-        '%B %d %H:%M, %Y',		    # December 24 05:00, 2012
-    ]
-
-    for fmt in formats:
+    for fmt in _date_formats(datestr):
         try:
             return datetime.datetime.strptime(datestr, fmt)
         except ValueError:
             continue
 
     print "Date %s unparsable" % datestr
-    if retbad:
-        return "Bad"
     return None
 
 
+# cache of fix_bad_unicode results, since display names ("Problem 1",
+# "Video", ...) repeat within and across courses; cleared when full
+FIX_UNICODE_CACHE_SIZE = 8192
+_FIX_UNICODE_CACHE = {}
+
+
+def _cached_fix_bad_unicode(text):
+    """
+    Memoized fix_bad_unicode (python 2 has no functools.lru_cache).
+    """
+    fixed = _FIX_UNICODE_CACHE.get(text)
+    if fixed is None:
+        if len(_FIX_UNICODE_CACHE) >= FIX_UNICODE_CACHE_SIZE:
+            _FIX_UNICODE_CACHE.clear()
+        fixed = _FIX_UNICODE_CACHE[text] = fix_bad_unicode(text)
+    return fixed
+
+
 class CourseInfo(object):
     """
     Gather course information from a course XML file.
     """
     def __init__(self, filename, policyfn='', course_dir=''):
         # pylint: disable=no-member
-        cxml = etree.parse(filename).getroot()
+        cxml = etree.parse(filename, XML_PARSER).getroot()
         self.cxml = cxml
         self.org = cxml.get('org')
         self.course = cxml.get('course')
@@ -211,7 +508,15 @@ class CourseInfo(object):
 
 def make_axis(course_dir):
     """
-    return dict of {course_id : { policy, xbundle, axis (as list of Axel elements) }}
+    return dict of {course_id : { policy, bundle_tree (xbundle as lxml element), axis (as list of Axel elements) }}
+    """
+    return dict(iter_course_axes(course_dir))
+
+def iter_course_axes(course_dir):
+    """
+    Generate (course_id, { policy, bundle_tree, axis }) for each course run
+    in course_dir, building each one only when it is asked for, so that a
+    caller can save and free one course tree before the next is loaded.
     """
     # Because pylint thinks lxml.etree has no parse or Element members...
     # pylint: disable=no-member
@@ -224,8 +529,6 @@ def make_axis(course_dir):
         )
     )
 
-    ret = {}
-
     # construct axis for each policy
     for cinfo in courses:
         policy = cinfo.policy
@@ -234,7 +537,7 @@ def make_axis(course_dir):
         log.debug('course_id={0}'.format(cid))
         # Generate XBundle for course.
         xml = etree.parse(
-            course_dir / ('course/%s.xml' % policy.semester)
+            course_dir / ('course/%s.xml' % policy.semester), XML_PARSER
         ).getroot()
         bundle = xbundle.XBundle(
             keep_urls=True,
@@ -244,26 +547,22 @@ def make_axis(course_dir):
         cxml = bundle.import_xml_removing_descriptor(course_dir, xml)
 
         # Append metadata.
-        metadata = etree.Element('metadata')
-        cxml.append(metadata)
-        policy_xml = etree.Element('policy')
-        policy_xml.text = json.dumps(policy.policy)
-        metadata.append(policy_xml)
-        grading_policy_xml = etree.Element('grading_policy')
-        grading_policy_xml.text = json.dumps(policy.grading_policy)
-        metadata.append(grading_policy_xml)
+        metadata = etree.SubElement(cxml, 'metadata')
+        policy_xml = etree.SubElement(metadata, 'policy')
+        policy_xml.text = policy.policy_json
+        grading_policy_xml = etree.SubElement(metadata, 'grading_policy')
+        grading_policy_xml.text = policy.grading_policy_json
 
         caxis = []
+        walk(cxml, course, cid, cinfo.org, policy, [1], caxis)
+        policy.clear_cache()
 
-        ret[cid] = dict(
+        yield cid, dict(
             policy=policy.policy,
-            bundle=etree.tostring(cxml, pretty_print=True),
+            bundle_tree=cxml,
             axis=caxis,
             grading_policy=policy.grading_policy,
         )
-        walk(cxml, course, cid, cinfo.org, policy, [1], caxis)
-
-    return ret
 
 def get_courses(course_dir):
     """
@@ -293,236 +592,292 @@ def get_courses(course_dir):
 
         return [CourseInfo(filename, pfn) for pfn in policies]
 
-def walk(
-        element, course, cid, org, policy, index, caxis, seq_num=1, paths=None,
-        seq_type=None, parent_start=None, parent=None, chapter=None):
+def _handle_video(element, attrib, url_name):
     """
-    Recursively traverse course tree.
-
-    element        = current etree element
-    seq_num  = sequence of current element in its parent, starting from 1
-    paths     = list of url_name's to current element, following edX's hierarchy conventions
-    seq_type = problemset, sequential, or videosequence
-    parent_start = start date of parent of current etree element
-    parent   = parent module
-    chapter  = the last chapter module_id seen while walking through the tree
+    data for video: youtube ID
     """
-
-    # Fixes dangerous-default-value.
-    if paths is None:
-        paths = []
-    url_name = element.get(
-        'url_name',
-        element.get(
-            'url_name_orig',
-            ''))
-    if not url_name:
-        display_name = element.get('display_name')
-        if display_name is not None:
-            # 2012 convention for converting display_name to url_name
-            url_name = display_name.strip().replace(
-                ' ',
-                '_')
-            url_name = url_name.replace(':', '_')
-            url_name = url_name.replace('.', '_')
-            url_name = url_name.replace(
-                '(', '_').replace(')', '_').replace('__', '_')
-
-    data = None
-    start = None
-
-    if not FORCE_NO_HIDE:
-        hide = policy.get_metadata(element, 'hide_from_toc')
-        if hide is not None and not hide == "false":
-            msg = (
-                '[edx2course_axis] Skipping {0} ({1}), it has '
-                'hide_from_toc={3}'
-            )
-            log.debug(
-                msg.format(
-                    element.tag, element.get('display_name', '<noname>'), hide)
-            )
-            return
-
-    # special: for video, let data = youtube ID(s)
-    if element.tag == 'video':
-        data = element.get('youtube', '')
-        if data:
-            # old ytid format - extract just the 1.0 part of this
-            # 0.75:JdL1Vo0Hru0,1.0:lbaG3uiQ6IY,1.25:Lrj0G8RWHKw,1.50:54fs3-WxqLs
-            ytid = data.replace(' ', '').split(',')
-            ytid = [
-                z[1] for z in [
-                    y.split(':') for y in ytid] if z[0] == '1.0']
-            if ytid:
-                data = ytid
-        if not data:
-            data = element.get('youtube_id_1_0', '')
-        if data:
-            data = '{"ytid": "%s"}' % data
-
-    if element.tag == 'problem' and element.get(
-            'weight') is not None and element.get('weight'):
+    # all handlers take the same arguments, used or not
+    # pylint: disable=unused-argument
+    data = attrib.get('youtube', '')
+    if data:
+        # old ytid format - extract just the 1.0 part of this
+        # 0.75:JdL1Vo0Hru0,1.0:lbaG3uiQ6IY,1.25:Lrj0G8RWHKw,1.50:54fs3-WxqLs
+        for speed in data.replace(' ', '').split(','):
+            rate, _, vid = speed.partition(':')
+            if rate == '1.0':
+                data = vid
+                break
+    if not data:
+        data = attrib.get('youtube_id_1_0', '')
+    if data:
+        data = json.dumps({'ytid': data})
+    return data
+
+
+def _handle_problem(element, attrib, url_name):
+    """
+    data for problem: weight, if given
+    """
+    # all handlers take the same arguments, used or not
+    # pylint: disable=unused-argument
+    weight = attrib.get('weight')
+    if weight:
         try:
-            data = '{"weight": %f}' % float(element.get('weight'))
+            return json.dumps({'weight': float(weight)})
         except (TypeError, ValueError) as err:
             log.error("Error converting weight {0}: {1}".format(
-                element.get('weight'), err,
+                weight, err,
             ))
+    return None
 
-    if element.tag == 'html':
-        iframe = element.find('.//iframe')
-        if iframe is not None:
-            log.debug("found iframe in html {0}".format(url_name))
-            src = iframe.get('src', '')
-            if 'https://www.youtube.com/embed/' in src:
-                match = re.search('embed/([^"/?]+)', src)
-                if match:
-                    data = '{"ytid": "%s"}' % match.group(1)
-                    log.debug("data={0}".format(data))
-
-    # url_name is mandatory if we are to do anything with this element
-    if url_name:
-        # url_name = url_name.replace(':','_')
-        display_name = element.get('display_name', url_name)
-        try:
-            display_name = unicode(display_name)
-            display_name = fix_bad_unicode(display_name)
-        except Exception as ex:
-            log.error(
-                'unicode error, type(display_name)={0}'.format(
-                    type(display_name)))
-            raise ex
-        # policy display_name - if given, let that override default
-        pdn = policy.get_metadata(element, 'display_name')
-        if pdn is not None:
-            display_name = pdn
-
-        start = date_parse(
-            policy.get_metadata(
-                element,
-                'start',
-                '',
-                parent=True))
-
-        if parent_start is not None and start < parent_start:
-            if VERBOSE_WARNINGS:
-                msg = (
-                    "Warning: start of {0} element {1} happens before start "
-                    "{2} of parent: using parent start"
-                )
-                log.warning(msg.format(start, element.tag, parent_start))
-            start = parent_start
-
-        # drop bad due date strings
-        if date_parse(element.get('due', None), retbad=True) == 'Bad':
-            element.set('due', '')
-
-        due = date_parse(
-            policy.get_metadata(
-                element,
-                'due',
-                '',
-                parent=True))
-        if element.tag == "problem":
-            log.debug(
-                "setting problem due date: for {0} due={1}".format(
-                    url_name, due))
-
-        gformat = element.get(
-            'format',
-            policy.get_metadata(
-                element,
-                'format',
-                ''))
-        if url_name == 'hw0':
-            log.debug("gformat for hw0 = {0}".format(gformat))
-
-        # compute path
-        # The hierarchy goes: `course > chapter > (problemset |
-        # sequential | videosequence)`
-
-        tags = set([
-            'problemset', 'sequential', 'videosequence', 'proctor', 'randomize'
-        ])
-        if element.tag == 'chapter':
-            paths = [url_name]
-        elif element.tag in tags:
-            seq_type = element.tag
-            paths = [paths[0], url_name]
-        else:
-            # note arrays are passed by reference, so copy, don't
-            # modify
-            paths = paths[:] + [str(seq_num)]
-
-        # compute module_id
-        if element.tag == 'html':
-            # module_id which appears in tracking log
-            module_id = '{0}/{1}/{2}/{3}'.format(
-                org, course, seq_type, '/'.join(paths[1:3]))
-        else:
-            module_id = '{0}/{1}/{2}/{3}'.format(
-                org, course, element.tag, url_name)
-
-        # done with getting all info for this axis element; save it
-        path_str = '/' + '/'.join(paths)
-        axel = Axel(
-            cid, index[
-                0], url_name, element.tag, gformat, start, due, display_name,
-            path_str, module_id, data, chapter,
-        )
+
+def _handle_html(element, attrib, url_name):
+    """
+    data for html: youtube ID of embedded youtube video, if any
+    """
+    # all handlers take the same arguments, used or not
+    # pylint: disable=unused-argument
+    # lazy iteration stops at the first iframe found
+    iframe = next(element.iter('iframe'), None)
+    if iframe is not None:
+        log.debug("found iframe in html {0}".format(url_name))
+        src = iframe.get('src', '')
+        if YT_EMBED_HOST in src:
+            match = YT_EMBED_RE.search(src)
+            if match:
+                data = json.dumps({'ytid': match.group(1)})
+                log.debug("data={0}".format(data))
+                return data
+    return None
+
+
+# functions returning the axis data for an element, by tag
+TAG_DATA_HANDLERS = {
+    'video': _handle_video,
+    'problem': _handle_problem,
+    'html': _handle_html,
+}
+
+
+def walk(cxml, course, cid, org, policy, index, caxis):
+    """
+    Traverse course tree rooted at cxml, appending an Axel to caxis for
+    each element.
+
+    index = one-element list holding the index of the next Axel; updated
+    """
+    for axel in iter_axis(cxml, course, cid, org, policy, index[0]):
         caxis.append(axel)
         index[0] += 1
-    else:
-        if VERBOSE_WARNINGS:
-            if element.tag in ['transcript', 'wiki', 'metadata']:
-                pass
-            else:
+
+
+def iter_axis(cxml, course, cid, org, policy, index=1):
+    """
+    Generate an Axel for each element of the course tree rooted at cxml,
+    in course order, numbering them from index.
+
+    The traversal is iterative, driven by lxml's iterwalk.  Each open element
+    has a frame on an explicit stack, holding the state its children inherit:
+
+    seq_num  = sequence of next child in the element, starting from 1
+    seq_type = problemset, sequential, or videosequence
+    start    = start date of the element (the parent_start of its children)
+    chapter  = the last chapter module_id seen while walking through the tree
+    inherit_seq_num = True if children keep the element's own seq_num
+    restore  = (keep, removed) to undo the element's change to paths, or None
+
+    paths is a single list of url_name's to the current element, following
+    edX's hierarchy conventions; it is modified in place on entering an
+    element, and restored on leaving it.
+
+    Children which are skipped entirely (eg <discussion>) get a None frame,
+    so that they do not advance their parent's seq_num.
+    """
+    get_all_metadata = policy.get_all_metadata
+    get_start_and_due = policy.get_start_and_due
+    parse_date = date_parse
+
+    # policy settings looked up for each element, with their defaults
+    metadata_defaults = {
+        'hide_from_toc': None, 'display_name': None, 'format': '',
+    }
+
+    # module_id prefix shared by all elements of the course
+    prefix = '%s/%s/' % (org, course)
+    # one copy of each tag name, shared by all the Axels with that category
+    tag_names = {}
+
+    paths = []
+    stack = []
+    context = etree.iterwalk(cxml, events=('start', 'end'))
+    for action, element in context:
+
+        if action == 'end':
+            frame = stack.pop()
+            if frame is not None:
+                if frame[5] is not None:
+                    keep, removed = frame[5]
+                    del paths[keep:]
+                    paths.extend(removed)
+                if stack and not stack[-1][4]:
+                    stack[-1][0] += 1
+            continue
+
+        tag = element.tag
+        tag = tag_names.setdefault(tag, tag)
+        attrib = element.attrib
+
+        if stack:
+            seq_num, seq_type, parent_start, chapter = stack[-1][:4]
+            parent = element.getparent()
+            # (comments need no check: iterwalk only yields elements)
+            if tag in SKIP_TAGS:
+                context.skip_subtree()
+                stack.append(None)
+                continue
+        else:
+            seq_num, seq_type, parent_start, chapter = 1, None, None, None
+            parent = None
+
+        url_name = attrib.get('url_name', attrib.get('url_name_orig', ''))
+        if not url_name:
+            display_name = attrib.get('display_name')
+            if display_name is not None:
+                # 2012 convention for converting display_name to url_name
+                url_name = display_name.strip().replace(
+                    ' ',
+                    '_')
+                url_name = url_name.replace(':', '_')
+                url_name = url_name.replace('.', '_')
+                url_name = url_name.replace(
+                    '(', '_').replace(')', '_').replace('__', '_')
+
+        data = None
+        start = None
+        module_id = None
+        restore = None
+
+        metadata = get_all_metadata(element, metadata_defaults)
+
+        if not FORCE_NO_HIDE:
+            hide = metadata['hide_from_toc']
+            if hide is not None and not hide == "false":
                 msg = (
-                    "Missing url_name for element {0} "
-                    "(attrib={1}, parent_tag={2})"
+                    '[edx2course_axis] Skipping {0} ({1}), it has '
+                    'hide_from_toc={2}'
                 )
-                log.warning(
+                log.debug(
                     msg.format(
-                        element, element.attrib,
-                        (parent.tag if parent is not None else ''))
+                        tag, attrib.get('display_name', '<noname>'), hide)
                 )
+                context.skip_subtree()
+                stack.append([seq_num, seq_type, None, chapter, False, None])
+                continue
+
+        # special data for some elements, eg youtube ID(s) for video
+        handler = TAG_DATA_HANDLERS.get(tag)
+        if handler is not None:
+            data = handler(element, attrib, url_name)
+
+        # url_name is mandatory if we are to do anything with this element
+        if url_name:
+            # url_name = url_name.replace(':','_')
+            display_name = attrib.get('display_name', url_name)
+            # lxml gives str for plain ascii attribute values
+            if isinstance(display_name, str):
+                display_name = display_name.decode('utf8', 'replace')
+            assert isinstance(display_name, unicode), type(display_name)
+            display_name = _cached_fix_bad_unicode(display_name)
+            # policy display_name - if given, let that override default
+            pdn = metadata['display_name']
+            if pdn is not None:
+                display_name = pdn
+
+            # ignore bad due date strings, without changing the element,
+            # which goes into the xbundle as authored
+            raw_due = attrib.get('due')
+            if raw_due and parse_date(raw_due, retbad=True) == 'Bad':
+                policy.override_attribute(element, 'due', '')
+
+            start, due = get_start_and_due(element)
+            start = parse_date(start)
+
+            if parent_start is not None and start < parent_start:
+                if VERBOSE_WARNINGS:
+                    msg = (
+                        "Warning: start of {0} element {1} happens before start "
+                        "{2} of parent: using parent start"
+                    )
+                    log.warning(msg.format(start, tag, parent_start))
+                start = parent_start
+
+            due = parse_date(due)
+            if tag == "problem":
+                log.debug(
+                    "setting problem due date: for {0} due={1}".format(
+                        url_name, due))
+
+            gformat = attrib.get('format', metadata['format'])
+            if url_name == 'hw0':
+                log.debug("gformat for hw0 = {0}".format(gformat))
+
+            # compute path
+            # The hierarchy goes: `course > chapter > (problemset |
+            # sequential | videosequence)`
+            if tag == 'chapter':
+                keep, segment = 0, url_name
+            elif tag in SEQ_TAGS:
+                seq_type = tag
+                keep, segment = 1, url_name
+            else:
+                keep, segment = len(paths), str(seq_num)
+            restore = (keep, paths[keep:])
+            del paths[keep:]
+            paths.append(segment)
+
+            # compute module_id
+            if tag == 'html':
+                # module_id which appears in tracking log
+                module_id = '%s%s/%s' % (
+                    prefix, seq_type, '/'.join(paths[1:3]))
+            else:
+                module_id = prefix + tag + '/' + url_name
 
-    # chapter?
-    if element.tag == 'chapter':
-        the_chapter = module_id
-    else:
-        the_chapter = chapter
-
-    # done processing this element, now process all its children
-    tags = set([
-        'html', 'problem', 'discussion', 'customtag', 'poll_question',
-        'combinedopenended', 'metadata',
-    ])
-    if element.tag not in tags:
+            # done with getting all info for this axis element; save it
+            path_str = '/' + '/'.join(paths)
+            yield Axel(
+                cid, index, url_name, tag, gformat, start, due, display_name,
+                path_str, module_id, data, chapter,
+            )
+            index += 1
+        else:
+            if VERBOSE_WARNINGS:
+                if tag in NO_URL_NAME_TAGS:
+                    pass
+                else:
+                    msg = (
+                        "Missing url_name for element {0} "
+                        "(attrib={1}, parent_tag={2})"
+                    )
+                    log.warning(
+                        msg.format(
+                            element, element.attrib,
+                            (parent.tag if parent is not None else ''))
+                    )
+
+        # chapter?
+        if tag == 'chapter':
+            chapter = module_id
+
+        # done processing this element; push the state for its children
         # if <vertical> with no url_name then keep seq_num for children
-        inherit_seq_num = (element.tag == 'vertical' and not url_name)
+        inherit_seq_num = (tag == 'vertical' and not url_name)
         if not inherit_seq_num:
             seq_num = 1
-        for child in element:
-            if (not str(child).startswith('<!--')) \
-                    and (not child.tag in ['discussion', 'source']):
-                walk(
-                    child,
-                    course,
-                    cid,
-                    org,
-                    policy,
-                    index,
-                    caxis,
-                    seq_num,
-                    paths,
-                    seq_type,
-                    parent_start=start,
-                    parent=element,
-                    chapter=the_chapter)
-                if not inherit_seq_num:
-                    seq_num += 1
+        stack.append(
+            [seq_num, seq_type, start, chapter, inherit_seq_num, restore])
+        if tag in LEAF_TAGS:
+            context.skip_subtree()
 
 def save_data_to_mongo(cid, caset, bundle=None):
     """
@@ -570,23 +925,24 @@ def fix_duplicate_url_name_vertical(axis):
 
     axis = list of Axel objects
     """
-    axis_by_url_name = defaultdict(list)
-    for idx in range(len(axis)):
-        ael = axis[idx]
-        axis_by_url_name[ael.url_name].append(idx)
+    axis_by_url_name = {}
+    for idx, ael in enumerate(axis):
+        axis_by_url_name.setdefault(ael.url_name, []).append((idx, ael))
 
-    for url_name, idxset in axis_by_url_name.items():
-        if len(idxset) == 1:
+    verbose = log.isEnabledFor(logging.DEBUG)
+    for url_name, aelset in axis_by_url_name.iteritems():
+        if len(aelset) == 1:
             continue
-        print "--> Duplicate url_name %s shared by:" % url_name
-        for idx in idxset:
-            ael = axis[idx]
-            print "       %s" % str(ael)
+        if verbose:
+            print "--> Duplicate url_name %s shared by:" % url_name
+        for idx, ael in aelset:
+            if verbose:
+                print "       %s" % str(ael)
             if ael.category == 'vertical':
                 nun = "%s_vertical" % url_name
-                print "          --> renaming url_name to become %s" % nun
-                new_ael = ael._replace(url_name=nun)
-                axis[idx] = new_ael
+                if verbose:
+                    print "          --> renaming url_name to become %s" % nun
+                axis[idx] = ael._replace(url_name=nun)
 
 
 def process_course(
@@ -594,122 +950,200 @@ def process_course(
     """
     if force_course_id is specified, then that value is used as the course_id
     """
-    ret = make_axis(course_path)
-
     # Save data as csv and txt: loop through each course (multiple policies
-    # can exist withing a given course dir).
-    for default_cid, cdat in ret.iteritems():
-
-        cid = force_course_id or default_cid
-
-        # Write out xbundle to xml file.
-        bfn = '%s/xbundle_%s.xml' % (DATADIR, cid.replace('/', '__'))
-        write_xbundle(bfn, ret[default_cid]['bundle'])
-
-        # Clean up xml file with xmllint if available.
-        if os.system('which xmllint') == 0:
-            os.system('xmllint --format %s > %s.new' % (bfn, bfn))
-            os.system('mv %s.new %s' % (bfn, bfn))
+    # can exist withing a given course dir).  Only one course tree is held
+    # at a time: each is emptied once it has been saved.
+    for default_cid, cdat in iter_course_axes(course_path):
+        save_course_data(
+            force_course_id or default_cid, cdat, use_dataset_latest)
+        cdat['bundle_tree'].clear()
+
+def save_course_data(cid, cdat, use_dataset_latest=False):
+    """
+    Save the xbundle and axis of one course, as generated by
+    iter_course_axes.
 
-        print "saving data for %s" % cid
+    The courses of a course dir are saved one after another: their
+    bundle_tree's are lxml elements, which cannot be pickled over to
+    worker processes.
+    """
+    # bundle for the optional savers, taken before write_xbundle
+    # re-indents the tree
+    if DO_SAVE_TO_MONGO or DO_SAVE_TO_BIGQUERY:
+        bundle = etree.tostring(cdat['bundle_tree'], pretty_print=True)
 
-        fix_duplicate_url_name_vertical(cdat['axis'])
+    # Write out xbundle to xml file.
+    bfn = '%s/xbundle_%s.xml' % (DATADIR, cid.replace('/', '__'))
+    write_xbundle(bfn, cdat['bundle_tree'])
 
-        header = (
-            "index", "url_name", "category", "gformat", "start", 'due',
-            "name", "path", "module_id", "data", "chapter_mid",
-        )
-        attribute_set = [
-            {x: getattr(ae, x) for x in header} for ae in cdat['axis']
-        ]
+    print "saving data for %s" % cid
 
-        # optional save to mongodb
-        if DO_SAVE_TO_MONGO:
-            save_data_to_mongo(cid, attribute_set, ret[default_cid]['bundle'])
+    fix_duplicate_url_name_vertical(cdat['axis'])
 
-        # optional save to bigquery
-        if DO_SAVE_TO_BIGQUERY:
-            save_data_to_bigquery(
-                cid,
-                attribute_set,
-                ret[default_cid]['bundle'],
-                cdat['log_msg'],
-                use_dataset_latest=use_dataset_latest)
+    if DO_SAVE_TO_MONGO or DO_SAVE_TO_BIGQUERY:
+        attribute_set = [ae.to_dict() for ae in cdat['axis']]
 
-        # save as text file
-        textfn = '{0}/axis_{1}.txt'.format(DATADIR, cid.replace('/', '__'))
+    # optional save to mongodb
+    if DO_SAVE_TO_MONGO:
+        save_data_to_mongo(cid, attribute_set, bundle)
 
-        write_text(textfn, header, attribute_set)
+    # optional save to bigquery
+    if DO_SAVE_TO_BIGQUERY:
+        save_data_to_bigquery(
+            cid,
+            attribute_set,
+            bundle,
+            cdat['log_msg'],
+            use_dataset_latest=use_dataset_latest)
 
-        # save as csv file
-        csvfn = '%s/axis_%s.csv' % (DATADIR, cid.replace('/', '__'))
-        write_csv(csvfn, header, cid, attribute_set)
+    # save as text and csv files
+    textfn = '{0}/axis_{1}.txt'.format(DATADIR, cid.replace('/', '__'))
+    csvfn = '%s/axis_%s.csv' % (DATADIR, cid.replace('/', '__'))
+    write_axis(textfn, csvfn, AXIS_HEADER, cdat['axis'])
 
-def write_xbundle(filename, bundle):
+def write_xbundle(filename, bundle_tree):
     """
-    Write xbundle XML.
+    Write xbundle XML, pretty-printed like "xmllint --format" would.
+
+    Descriptor files are parsed by xbundle with their whitespace intact,
+    which stops pretty_print from indenting them; so, much as xmllint
+    does, blank text between elements is first dropped (in place).
     """
-    codecs.open(filename, 'w', encoding='utf8').write(bundle)
+    strip_blank_text(bundle_tree)
+    bundle_tree.getroottree().write(
+        filename, pretty_print=True, xml_declaration=True, encoding='utf-8')
 
     print "Writing out xbundle to %s" % filename
 
-    # Clean up xml file with xmllint if available.
-    if os.system('which xmllint') == 0:
-        os.system('xmllint --format %s > %s.new' % (filename, filename))
-        os.system('mv %s.new %s' % (filename, filename))
-
-def write_text(filename, header, attribute_set):
+def strip_blank_text(root):
     """
-    Print out to text file
+    Drop the whitespace-only text between the children of element-only
+    nodes, so that pretty_print can indent them.  Mixed content, ie
+    elements holding any real text, is left exactly as it is.
     """
-    afp = codecs.open(filename, 'w', encoding='utf8')
-    aformat = "%8s\t%40s\t%24s\t%16s\t%16s\t%16s\t%s\t%s\t%s\t%s\t%s\n"
-    afp.write(aformat % header)
-    afp.write(aformat % tuple(["--------"] * 11))
-    for attributes in attribute_set:
-        afp.write(aformat % tuple([attributes[x] for x in header]))
-    afp.close()
+    for elem in root.iter(tag=etree.Element):
+        if not len(elem):
+            continue
+        if elem.text is not None and elem.text.strip(XML_BLANKS):
+            continue
+        if any(child.tail is not None and child.tail.strip(XML_BLANKS)
+               for child in elem):
+            continue
+        elem.text = None
+        for child in elem:
+            child.tail = None
 
-def write_csv(filename, header, cid, attribute_set):
+def write_axis(textfn, csvfn, header, axis):
     """
-    Export as CSV.
+    Write out course axis (list of Axel elements) to text and CSV files,
+    in a single pass.  Both files are formatted in memory, then written
+    out with one write call each.
     """
-    filename = '%s/axis_%s.csv' % (DATADIR, cid.replace('/', '__'))
-    csv_file = open(filename, 'wb')
+    aformat = u"%8s\t%40s\t%24s\t%16s\t%16s\t%16s\t%s\t%s\t%s\t%s\t%s\n"
+    lines = [aformat % header, aformat % tuple(["--------"] * 11)]
+
+    csv_buf = io.BytesIO()
     writer = csv.writer(
-        csv_file,
+        csv_buf,
         dialect="excel",
         quotechar='"',
         quoting=csv.QUOTE_ALL)
     writer.writerow(header)
-    for attributes in attribute_set:
+
+    # fixed tuple positions of the header fields, for a C-level itemgetter
+    get_row = operator.itemgetter(*[Axel._fields.index(h) for h in header])
+    for ae in axis:
+        row = get_row(ae)
+        lines.append(aformat % row)
         try:
-            data = [('%s' % attributes[k]).encode('utf8') for k in header]
+            data = [('%s' % x).encode('utf8') for x in row]
             writer.writerow(data)
         except UnicodeEncodeError as err:
-            log.error("Failed to write row {0}: {1}".format(data, err))
-    csv_file.close()
-    print "Saved course axis to %s" % filename
+            log.error("Failed to write row {0}: {1}".format(row, err))
+
+    with io.open(textfn, 'w', encoding='utf8') as afp:
+        afp.write(u''.join(lines))
+    with open(csvfn, 'wb') as csv_file:
+        csv_file.write(csv_buf.getvalue())
+    print "Saved course axis to %s" % csvfn
+
+def _escapes_dir(name):
+    """
+    True if the relative path name could resolve outside of its directory.
+    """
+    return os.path.isabs(name) or '..' in name.split('/')
+
+def _is_safe_tar_member(member):
+    """
+    True if extracting tar member cannot write outside the extraction dir,
+    either directly, or through a symbolic or hard link it creates.
+    """
+    if _escapes_dir(member.name):
+        return False
+    if (member.issym() or member.islnk()) and _escapes_dir(member.linkname):
+        return False
+    return True
 
 def process_xml_tar_gz_file(
         fndir, use_dataset_latest=False, force_course_id=None):
     """
     convert *.xml.tar.gz to course axis
-    This could be improved to use the python tar & gzip libraries.
     """
-    fnabs = os.path.abspath(fndir)
     tdir = tempfile.mkdtemp()
-    cmd = "cd %s; tar xzf %s" % (tdir, fnabs)
-    print "running %s" % cmd
-    os.system(cmd)
-    newfn = glob.glob('%s/*' % tdir)[0]
-    print "Using %s as the course xml directory" % newfn
-    process_course(
-        newfn,
-        use_dataset_latest=use_dataset_latest,
-        force_course_id=force_course_id)
-    print "removing temporary files %s" % tdir
-    os.system('rm -rf %s' % tdir)
+    try:
+        print "extracting %s into %s" % (fndir, tdir)
+        with tarfile.open(fndir, 'r:gz') as tfp:
+            members = [
+                member for member in tfp.getmembers()
+                if _is_safe_tar_member(member)
+            ]
+            tfp.extractall(tdir, members)
+        newfn = glob.glob('%s/*' % tdir)[0]
+        print "Using %s as the course xml directory" % newfn
+        process_course(
+            newfn,
+            use_dataset_latest=use_dataset_latest,
+            force_course_id=force_course_id)
+    finally:
+        print "removing temporary files %s" % tdir
+        shutil.rmtree(tdir, ignore_errors=True)
+
+def process_file(filename, datadir=None, do_save_to_mongo=None):
+    """
+    Produce course axis for a course directory or *.tar.gz file.
+
+    datadir and do_save_to_mongo, if given, override DATADIR and
+    DO_SAVE_TO_MONGO; they are passed explicitly to worker processes,
+    which cannot rely on inheriting the values set by main().
+    """
+    global DATADIR
+    global DO_SAVE_TO_MONGO
+
+    if datadir is not None:
+        DATADIR = datadir
+    if do_save_to_mongo is not None:
+        DO_SAVE_TO_MONGO = do_save_to_mongo
+
+    if os.path.isdir(filename):
+        process_course(filename)
+    else:
+        # not a directory - is it a tar.gz file?
+        if filename.endswith('.tar.gz') or filename.endswith('.tgz'):
+            process_xml_tar_gz_file(filename)
+
+def _process_file_args(args):
+    """
+    process_file taking a tuple of arguments, for multiprocessing.Pool.map
+
+    Returns None on success, or the formatted traceback of the failure:
+    exceptions such as lxml's XMLSyntaxError cannot be unpickled in the
+    parent, and would leave Pool.map waiting forever.
+    """
+    try:
+        process_file(*args)
+    except Exception:  # pylint: disable=broad-except
+        return traceback.format_exc()
+    return None
 
 def main():
     """
@@ -731,13 +1165,29 @@ def main():
 
     if not os.path.exists(DATADIR):
         os.mkdir(DATADIR)
-    for filename in sys.argv[1:]:
-        if os.path.isdir(filename):
-            process_course(filename)
-        else:
-            # not a directory - is it a tar.gz file?
-            if filename.endswith('.tar.gz') or filename.endswith('.tgz'):
-                process_xml_tar_gz_file(filename)
+
+    filenames = sys.argv[1:]
+    if len(filenames) > 1:
+        # courses are independent: process them in parallel, one per core
+        pool = multiprocessing.Pool()
+        try:
+            errors = pool.map(
+                _process_file_args,
+                [(fn, DATADIR, DO_SAVE_TO_MONGO) for fn in filenames])
+        finally:
+            pool.close()
+            pool.join()
+        failed = [
+            (fn, err) for fn, err in zip(filenames, errors) if err is not None
+        ]
+        for filename, err in failed:
+            sys.stderr.write(
+                "Error processing %s:\n%s" % (filename, err))
+        if failed:
+            sys.exit(1)
+    else:
+        for filename in filenames:
+            process_file(filename)
 
 if __name__ == '__main__':
     main()